@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from schema import PAGE_SCHEMA
+
+
+"""
+Completion tokens and latency per page, verbose keys vs the compact aliased keys of schema.py.
+
+offline (default): the same parsed page is serialized both ways and the tokens are counted (tiktoken if installed,
+    ~4 characters per token otherwise). The short keys are compared on minified json, the indentation saving is shown
+    apart. Latency is estimated from --tokens-per-second
+live (--live resume.pdf): every page of the resume is posted through the configured llm backends in both formats,
+    and the completion tokens and latency reported by the api are compared
+
+$ python benchmarks/compact_schema.py
+$ python benchmarks/compact_schema.py --live resume.pdf --runs 3
+"""
+
+SAMPLE_PAGE = {
+    'personal information': {
+        'name': 'Jane Doe', 'gender': 'Female', 'birth year': '1990', 'phone number': '+852 5555 1234',
+        'email': 'jane.doe@example.com', 'desired salary:': 'HKD 60,000 per month', 'industry': 'Finance',
+        'nationality': 'Canadian', 'current country': 'Hong Kong', 'current city': 'Hong Kong'
+    },
+    'experience': [
+        {'company name': 'Example Bank', 'position': 'Senior Data Analyst', 'duration': 'Mar 2019 - Present',
+         'achievement': 'Cut month end reporting from 5 days to 1 day. Promoted to team lead in 2021.',
+         'responsibility': 'Own the credit risk dashboards. Lead a team of 4 analysts.'},
+        {'company name': 'Example Consulting', 'position': 'Analyst', 'duration': 'Jul 2015 - Feb 2019',
+         'achievement': 'Delivered 12 client projects.', 'responsibility': 'Data modelling and client reporting.'},
+        {'company name': 'N/A', 'position': '', 'duration': '', 'achievement': '', 'responsibility': ''}
+    ],
+    'education': [
+        {'school name': 'University of Toronto', 'education level': 'Bachelor', 'major': 'Statistics',
+         'duration': 'Sep 2011 - Jun 2015'},
+        {'school name': 'N/A', 'education level': '', 'major': '', 'duration': ''}
+    ]
+}
+
+
+def get_token_counter():
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding('cl100k_base')
+        return lambda text: len(encoding.encode(text)), 'tiktoken cl100k_base'
+    except Exception:
+        # not installed, or the encoding cannot be downloaded
+        return lambda text: len(text) // 4, '~4 characters per token'
+
+
+def offline(tokens_per_second):
+    count_tokens, counter_name = get_token_counter()
+    # verbose answers usually come indented, the compact prompt asks for minified json. The two savings are reported
+    # apart: the short keys against the same minified layout, and the indentation on its own
+    verbose_indented = count_tokens(json.dumps(SAMPLE_PAGE, ensure_ascii=False, indent=2))
+    verbose_tokens = count_tokens(json.dumps(SAMPLE_PAGE, ensure_ascii=False, separators=(',', ':')))
+    compact_tokens = count_tokens(json.dumps(PAGE_SCHEMA.compact(SAMPLE_PAGE), ensure_ascii=False,
+                                             separators=(',', ':')))
+
+    print(f'token count: {counter_name}')
+    print(f'completion tokens per page, both minified: verbose {verbose_tokens}, compact {compact_tokens}, '
+          f'saved {verbose_tokens - compact_tokens} ({1 - compact_tokens / verbose_tokens:.0%}) by the short keys')
+    print(f'indentation of a verbose answer: {verbose_indented} tokens indented, {verbose_tokens} minified, '
+          f'saved {verbose_indented - verbose_tokens} by asking for minified json')
+    print(f'estimated latency per page at {tokens_per_second} tokens/s: verbose indented '
+          f'{verbose_indented / tokens_per_second:.1f} s, verbose minified {verbose_tokens / tokens_per_second:.1f} s, '
+          f'compact {compact_tokens / tokens_per_second:.1f} s')
+    prompt_verbose = count_tokens(PAGE_SCHEMA.prompt(compact=False))
+    prompt_compact = count_tokens(PAGE_SCHEMA.prompt(compact=True))
+    print(f'format instructions in the prompt: verbose {prompt_verbose} tokens, compact {prompt_compact} tokens')
+
+
+async def live(pdf_path, runs):
+    import main
+
+    pages = main.extract(pdf_path)
+    for compact in (False, True):
+        tokens, latencies = [], []
+        for _ in range(runs):
+            for page in pages:
+                t0 = time.perf_counter()
+                json_file = (await main.post_separate([page], compact=compact))[0]
+                latencies.append(time.perf_counter() - t0)
+                if main.is_parsed_page(json_file):
+                    tokens.append(json_file['usage']['completion_tokens'])
+        label = 'compact' if compact else 'verbose'
+        if tokens:
+            print(f'{label}: {statistics.mean(tokens):.0f} completion tokens and '
+                  f'{statistics.median(latencies):.1f} s per page (median of {len(latencies)} pages)')
+        else:
+            print(f'{label}: no successful responses, check the backends in main.py')
+    await main.llm_router.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--live', metavar='RESUME', help='post the pages of this resume through the llm backends')
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--tokens-per-second', type=float, default=40,
+                        help='completion speed of the deployment, for the offline latency estimate')
+    args = parser.parse_args()
+    if args.live:
+        asyncio.run(live(os.path.abspath(args.live), args.runs))
+    else:
+        offline(args.tokens_per_second)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+"""
+Import time of main.py and latency of the first requests, with and without the startup warm up.
+Every run is a fresh python process so that nothing is cached between them.
+
+$ python benchmarks/startup.py --runs 5
+"""
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_TIME = '''
+import sys, time
+sys.path.insert(0, {repo_dir!r})
+t0 = time.perf_counter()
+import main
+print(time.perf_counter() - t0)
+'''
+
+FIRST_REQUEST = '''
+import io, json, sys, time
+sys.path.insert(0, {repo_dir!r})
+import main
+from pypdf import PdfWriter
+from fastapi.testclient import TestClient
+
+main.WARMUP = {warmup!r}
+writer = PdfWriter()
+writer.add_blank_page(612, 792)
+pdf = io.BytesIO()
+writer.write(pdf)
+# drop the import of pypdf done above, the first request should pay for it as it would in the app
+for name in [name for name in sys.modules if name == 'pypdf' or name.startswith('pypdf.')]:
+    del sys.modules[name]
+
+t0 = time.perf_counter()
+with TestClient(main.app) as client:
+    t1 = time.perf_counter()
+    client.get('/metrics')
+    t2 = time.perf_counter()
+    main.extract(pdf.getvalue())
+    t3 = time.perf_counter()
+print(json.dumps({{'startup': t1 - t0, 'first /metrics': t2 - t1, 'first extract': t3 - t2}}))
+'''
+
+
+def run(code):
+    # extract() writes last_page.txt into the working directory
+    with tempfile.TemporaryDirectory() as work_dir:
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=work_dir)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return result.stdout.strip().splitlines()[-1]
+
+
+def median_of(samples):
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    import_times = [float(run(IMPORT_TIME.format(repo_dir=REPO_DIR))) for _ in range(args.runs)]
+    print(f'import main: {statistics.median(import_times) * 1000:.0f} ms (median of {args.runs})')
+
+    for label, warmup in (('no warm up', ()), ('warm up', ('imports', 'http', 'tessdata', 'pdf_pool'))):
+        samples = [json.loads(run(FIRST_REQUEST.format(repo_dir=REPO_DIR, warmup=warmup))) for _ in range(args.runs)]
+        timings = ', '.join(f'{key}: {value * 1000:.0f} ms' for key, value in median_of(samples).items())
+        print(f'{label}: {timings}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import hashlib
+import random
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+
+"""
+Near-duplicate detection for resumes.
+The same candidate often uploads slightly different files (re-exported pdf, new phone number, a job board watermark).
+Each resume is fingerprinted with MinHash over character shingles of the normalized text, and indexed with LSH so
+that a new upload can be matched against the known resumes without comparing it to every one of them.
+"""
+
+# largest prime below 2 ** 32, so that a * h + b of 32 bit hashes stays below 2 ** 64 in numpy uint64
+_PRIME = (1 << 32) - 5
+_MAX_HASH = (1 << 32) - 1
+
+
+def normalize_text(text):
+    text = text.lower()
+    text = re.sub(r'[^\w\s]', ' ', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+
+def shingles(text, k=5):
+    # character shingles, so that chinese and korean resumes (no spaces between words) work as well
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+class MinHash:
+    """
+    chunk_size: shingles hashed against all the permutations at once, bounds the memory of one numpy block
+    """
+
+    def __init__(self, num_perm=128, shingle_size=5, seed=1, chunk_size=4096):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.chunk_size = chunk_size
+        rng = random.Random(seed)
+        self.permutations = [(rng.randint(1, _PRIME - 1), rng.randint(0, _PRIME - 1)) for _ in range(num_perm)]
+        self._arrays = None
+
+    def _get_arrays(self):
+        # numpy is imported on first use, to keep it out of the startup of the app
+        if self._arrays is None:
+            import numpy as np
+            self._arrays = (np.array([a for a, _ in self.permutations], dtype=np.uint64),
+                            np.array([b for _, b in self.permutations], dtype=np.uint64))
+        return self._arrays
+
+    def signature(self, text):
+        import numpy as np
+        hashes = [zlib.crc32(s.encode('utf-8')) for s in shingles(text, self.shingle_size)]
+        if not hashes:
+            return (_MAX_HASH,) * self.num_perm
+        a, b = self._get_arrays()
+        signature = np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        for start in range(0, len(hashes), self.chunk_size):
+            chunk = np.array(hashes[start:start + self.chunk_size], dtype=np.uint64)[:, None]
+            np.minimum(signature, ((chunk * a + b) % _PRIME).min(axis=0), out=signature)
+        return tuple(signature.tolist())
+
+    def union(self, signatures):
+        """
+        signature of the union of the shingle sets, the element-wise min of their signatures
+        """
+        if not signatures:
+            return (_MAX_HASH,) * self.num_perm
+        return tuple(min(values) for values in zip(*signatures))
+
+
+def similarity(signature_a, signature_b):
+    # estimated jaccard similarity of the two shingle sets
+    if not signature_a or len(signature_a) != len(signature_b):
+        return 0.0
+    return sum(1 for a, b in zip(signature_a, signature_b) if a == b) / len(signature_a)
+
+
+class Fingerprint:
+    def __init__(self, signature, page_signatures, page_digests):
+        self.signature = signature
+        self.page_signatures = page_signatures
+        self.page_digests = page_digests
+
+
+class Entry:
+    def __init__(self, key, fingerprint, results):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.results = results
+
+
+class ResumeIndex:
+    """
+    LSH index of the resumes parsed so far, with the per-page parse results attached to each of them.
+
+    threshold: minimum estimated similarity of the whole text for two resumes to count as near duplicates
+    page_threshold: minimum estimated similarity for a page to reuse the prior parse of that page.
+                    1.0 only reuses pages whose normalized text is identical
+    bands: number of LSH bands, num_perm must be divisible by it
+    max_entries: the least recently used resumes are dropped beyond this
+    """
+
+    def __init__(self, threshold=0.9, page_threshold=1.0, num_perm=128, bands=16, shingle_size=5, max_entries=1000):
+        if num_perm % bands != 0:
+            raise ValueError('num_perm must be divisible by bands')
+        self.threshold = threshold
+        self.page_threshold = page_threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.minhash = MinHash(num_perm=num_perm, shingle_size=shingle_size)
+        self.entries = OrderedDict()
+        self.buckets = [{} for _ in range(bands)]
+        self.next_key = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, pages):
+        if isinstance(pages, str):
+            pages = [pages]
+        normalized = [normalize_text(page) for page in pages]
+        page_signatures = [self.minhash.signature(page) for page in normalized]
+        return Fingerprint(
+            # the whole text is (up to the shingles across page breaks) the union of the pages, no second pass
+            signature=self.minhash.union(page_signatures),
+            page_signatures=page_signatures,
+            page_digests=[hashlib.sha1(page.encode('utf-8')).hexdigest() for page in normalized]
+        )
+
+    def _band_keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows] for i in range(self.bands)]
+
+    def lookup(self, fingerprint):
+        """
+        return the most similar known resume above the threshold, or None
+        """
+        with self.lock:
+            candidates = set()
+            for bucket, band in zip(self.buckets, self._band_keys(fingerprint.signature)):
+                candidates.update(bucket.get(band, ()))
+
+            best, best_similarity = None, self.threshold
+            for key in candidates:
+                entry = self.entries[key]
+                cur_similarity = similarity(fingerprint.signature, entry.fingerprint.signature)
+                if cur_similarity >= best_similarity:
+                    best, best_similarity = entry, cur_similarity
+
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best.key)
+            print('near duplicate resume found, similarity:', best_similarity)
+            return best
+
+    def reusable_pages(self, fingerprint, entry):
+        """
+        map the index of every new page that is (nearly) unchanged to the prior parse result of that page
+        """
+        prior_pages = list(zip(entry.fingerprint.page_digests, entry.fingerprint.page_signatures, entry.results))
+        reusable = {}
+        for idx, (digest, signature) in enumerate(zip(fingerprint.page_digests, fingerprint.page_signatures)):
+            for prior_digest, prior_signature, result in prior_pages:
+                if digest == prior_digest or (self.page_threshold < 1.0 and
+                                              similarity(signature, prior_signature) >= self.page_threshold):
+                    reusable[idx] = result
+                    break
+        return reusable
+
+    def add(self, fingerprint, results):
+        with self.lock:
+            key = self.next_key
+            self.next_key += 1
+            self.entries[key] = Entry(key, fingerprint, results)
+            for bucket, band in zip(self.buckets, self._band_keys(fingerprint.signature)):
+                bucket.setdefault(band, set()).add(key)
+
+            while len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self._remove_from_buckets(evicted)
+            return key
+
+    def _remove_from_buckets(self, entry):
+        for bucket, band in zip(self.buckets, self._band_keys(entry.fingerprint.signature)):
+            keys = bucket.get(band)
+            if keys is None:
+                continue
+            keys.discard(entry.key)
+            if not keys:
+                del bucket[band]
+
+    def remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self._remove_from_buckets(entry)
+
+    def metrics(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
@@ -1,55 +1,127 @@
-import openai
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_random_exponential,
-    retry_if_exception_type
-)
 import json
 import re
 import os
-import io
-import aiohttp
 import asyncio
 import time
-from pypdf import PdfReader
-from pdf2image import convert_from_bytes
-import pytesseract
-import uvicorn
+import tempfile
 from fastapi import Form, File, UploadFile, FastAPI
 from typing import Annotated
-from a2wsgi import ASGIMiddleware
-from docx2python import docx2python
+from fingerprint import ResumeIndex
+from ocr_engine import OcrEngine
+import pdf_text
+from pdf_text import clean_page_text, extract_parallel
+from router import Backend, Router
+from schema import ONE_PASS_SCHEMA, PAGE_SCHEMA
+from scheduler import BULK, INTERACTIVE, Scheduler, start_request
+from upload import UploadSizeLimit, open_source, spooled_upload
 
 
 '''
 pre-defined values
 '''
 app = FastAPI()
+# uploads over UPLOAD_SPOOL_THRESHOLD bytes are spooled to a temp file, the ones over MAX_UPLOAD_BYTES bytes or
+# MAX_UPLOAD_PAGES pages are rejected with 413
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+UPLOAD_SPOOL_THRESHOLD = 1024 * 1024
+MAX_UPLOAD_PAGES = 50
 os.environ['TESSDATA_PREFIX'] = os.path.join(os.path.dirname(__file__), 'tess_data')
 GPT4Engine = ''
 GPT35Engine = ''
-openai.api_type = ""
-openai.api_version = ""
-openai.api_base = ""
-openai.api_key = ""
+AZURE_API_VERSION = ""
+AZURE_API_BASE = ""
+AZURE_API_KEY = ""
 GPT35URL = ''
 
+# text layer extraction of pdfs with at least PDF_PARALLEL_MIN_PAGES pages is split across PDF_WORKERS processes,
+# None or a single worker keeps it in the request thread
+PDF_PARALLEL_MIN_PAGES = 16
+PDF_WORKERS = min(4, os.cpu_count() or 1)
+
+# ocr: the language packs a scanned page may need. With OCR_DETECT_LANGUAGE every page only loads the packs of the
+# scripts detected on the first page of its document (plus eng next to chi_sim or kor), a page that comes back
+# mostly unrecognised is detected again on its own. Packs missing from tess_data are skipped
+OCR_LANGUAGES = 'eng+chi_sim+kor'
+OCR_DETECT_LANGUAGE = True
+ocr_engine = OcrEngine(languages=OCR_LANGUAGES, tessdata_dir=os.environ['TESSDATA_PREFIX'], detect=OCR_DETECT_LANGUAGE)
+# pages are rendered a few at a time, as many as fit in OCR_MEMORY_BUDGET bytes, instead of the whole document at once.
+# A single page too large for the budget at OCR_DPI is rendered at a lower dpi. Pages after OCR_MAX_PAGES are not read
+OCR_STREAMING = True
+OCR_DPI = 200
+OCR_GRAYSCALE = True
+OCR_MAX_PAGES = 30
+OCR_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# ask the model for short aliased keys instead of echoing the full keys for every entry, the answers are expanded
+# back to the full keys. Cuts the completion tokens per page, see benchmarks/compact_schema.py
+COMPACT_SCHEMA = True
+
+# near duplicate detection: 'pages' re-parses only the changed pages, 'document' returns the prior parse as it is
+NEAR_DUPLICATE_MODE = 'pages'
+NEAR_DUPLICATE_THRESHOLD = 0.9
+PAGE_REUSE_THRESHOLD = 1.0
+resume_index = ResumeIndex(threshold=NEAR_DUPLICATE_THRESHOLD, page_threshold=PAGE_REUSE_THRESHOLD)
+
+# llm calls: seconds a request may spend on one llm call including all retries, and per attempt
+LLM_LATENCY_BUDGET = 120
+LLM_REQUEST_TIMEOUT = 60
+LLM_MAX_ATTEMPTS = 10
+LLM_MAX_BACKOFF = 60
+# the breaker opens when BREAKER_FAILURE_RATE of the last BREAKER_WINDOW calls failed, and retries after the cooldown
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_COOLDOWN = 30
+# a page that takes longer than the HEDGE_PERCENTILE latency gets a duplicate request, None disables hedging
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+# weight of the latest call in the per backend latency average, and seconds to avoid a backend after a 429
+LATENCY_EWMA_ALPHA = 0.3
+RATE_LIMIT_COOLDOWN = 10
+
+# llm backends and the task classes ('page', 'one pass', 'summary', 'reference', 'cpr') each of them may serve.
+# Every call goes to the fastest healthy backend allowed for its task, add more deployments to spread the load.
+# tokens_per_minute and requests_per_minute are the quota of the deployment, calls queue up instead of going over it.
+# At most LLM_BURST_SECONDS of the quota go out at once after an idle period
+LLM_BURST_SECONDS = 10
+LLM_BACKENDS = [
+    {'name': 'azure-gpt35', 'kind': 'azure', 'deployment': GPT35Engine, 'url': GPT35URL,
+     'tasks': ('page', 'summary', 'reference'), 'tokens_per_minute': 120000, 'requests_per_minute': 720},
+    {'name': 'azure-gpt4', 'kind': 'azure', 'deployment': GPT4Engine, 'tasks': ('one pass', 'cpr'),
+     'tokens_per_minute': 20000, 'requests_per_minute': 120},
+    # {'name': 'openai-gpt35', 'kind': 'openai', 'model': 'gpt-3.5-turbo', 'api_key': '', 'organization': '',
+    #  'tasks': ('page', 'summary', 'reference')},
+    # {'name': 'local', 'kind': 'local', 'model': '', 'api_base': 'http://127.0.0.1:8080/v1',
+    #  'tasks': ('page', 'summary', 'reference')},
+]
+llm_router = Router(latency_budget=LLM_LATENCY_BUDGET, request_timeout=LLM_REQUEST_TIMEOUT,
+                    max_attempts=LLM_MAX_ATTEMPTS, max_backoff=LLM_MAX_BACKOFF,
+                    breaker_failure_rate=BREAKER_FAILURE_RATE, breaker_window=BREAKER_WINDOW,
+                    breaker_min_calls=BREAKER_MIN_CALLS, breaker_cooldown=BREAKER_COOLDOWN,
+                    hedge_percentile=HEDGE_PERCENTILE, hedge_min_samples=HEDGE_MIN_SAMPLES,
+                    ewma_alpha=LATENCY_EWMA_ALPHA, rate_limit_cooldown=RATE_LIMIT_COOLDOWN,
+                    scheduler=Scheduler(burst_seconds=LLM_BURST_SECONDS))
+for backend_config in LLM_BACKENDS:
+    if backend_config.get('kind', 'azure') == 'azure':
+        # azure deployments share the credentials above unless they have their own
+        backend_config = {'api_base': AZURE_API_BASE, 'api_key': AZURE_API_KEY,
+                          'api_version': AZURE_API_VERSION, **backend_config}
+    llm_router.register(Backend(**backend_config))
+
+# done at startup, before the worker reports ready, so that the first request does not pay for it:
+# 'imports': pdf, ocr and docx libraries, 'http': connection pool and a connection to every llm backend,
+# 'tessdata': tesseract language packs check, 'pdf_pool': worker processes of the parallel pdf extraction.
+# A worker that only serves /summarize or /reference can drop everything but 'http'
+WARMUP = ('imports', 'http', 'tessdata', 'pdf_pool')
+
 """
 General Helper functions
 """
 
 
-# backoff
-@retry(
-    retry=retry_if_exception_type((openai.error.APIError, openai.error.APIConnectionError,
-                                   openai.error.RateLimitError, openai.error.ServiceUnavailableError,
-                                   openai.error.Timeout)),
-    wait=wait_random_exponential(multiplier=1, max=60),
-    stop=stop_after_attempt(10)
-)
-def chat_completion_with_backoff(**kwargs):
-    return openai.ChatCompletion.create(**kwargs)
+# backoff and routing
+def chat_completion_with_backoff(task, **kwargs):
+    return llm_router.complete(task, **kwargs)
 
 
 def auto_complete_json_brackets(s):
@@ -93,21 +165,22 @@ def auto_complete_json_brackets(s):
 """
 Two ways to extract texts
 1. extract_pdf, extract_docx (extract directly, fast, most of the time accurate)
-2. ocr (slow, need to know the content language in advance, as accurate as method 1)
+2. ocr (slow, detects the content language of each page, as accurate as method 1)
 """
 
 # convert doc into pdf in batch: $ soffice --headless --convert-to pdf *.doc
 # convert docx into pdf in batch $ soffice --headless --convert-to pdf *.docx
 
 
-def extract(input_file):
+def extract(input_file, max_pages=None):
+    # max_pages: stop after the first max_pages pages, for callers that only need part of the resume
     try:
-        return extract_pdf(input_file)
+        return extract_pdf(input_file, max_pages=max_pages)
     except Exception as err:
         print(f"Unexpected {err=}, {type(err)=}")
 
     try:
-        return ocr(input_file)
+        return ocr(input_file, max_pages=max_pages)
     except Exception as err:
         print(f"Unexpected {err=}, {type(err)=}")
 
@@ -119,33 +192,132 @@ def extract(input_file):
     return ''
 
 
-def extract_pdf(input_file):
+def extract_pdf(input_file, max_pages=None):
     t0 = time.perf_counter()
-    reader = PdfReader(io.BytesIO(input_file))
     pages = []
-    for page in reader.pages:
-        para = page.extract_text()
-        para = re.sub(r'\n+', '\n', para)
-        para = re.sub(r' +', ' ', para)
-        # print(para)
-        # print('*'* 80)
-        pages.append(para)
+    with open_source(input_file) as stream:
+        from pypdf import PdfReader
+        reader = PdfReader(stream)
+        page_count = len(reader.pages) if max_pages is None else min(max_pages, len(reader.pages))
+        parallel = PDF_PARALLEL_MIN_PAGES and PDF_WORKERS > 1 and page_count >= PDF_PARALLEL_MIN_PAGES
+        if not parallel:
+            for page in reader.pages[:page_count]:
+                para = clean_page_text(page.extract_text())
+                # print(para)
+                # print('*'* 80)
+                pages.append(para)
+    if parallel:
+        pages = extract_parallel(input_file, page_count, PDF_WORKERS)
     t1 = time.perf_counter()
     print('extraction time:', t1 - t0)
-    with open('last_page.txt', 'w', encoding='utf-8') as f:
-        f.write(pages[-1])
+    if max_pages is None:
+        with open('last_page.txt', 'w', encoding='utf-8') as f:
+            f.write(pages[-1])
     return pages
 
 
-def ocr(input_file):
+def ocr_page_sizes(pdf_path, pdf_info, page_count):
+    # size in points of every page, as pdftoppm renders it (crop box, user unit, rotation)
+    from pypdf import PdfReader
+    try:
+        with open_source(pdf_path) as stream:
+            reader = PdfReader(stream)
+            sizes = []
+            for page in reader.pages[:page_count]:
+                unit = float(page.get('/UserUnit', 1))
+                width, height = float(page.cropbox.width) * unit, float(page.cropbox.height) * unit
+                sizes.append((height, width) if page.rotation % 180 else (width, height))
+            return sizes
+    except Exception as err:
+        # broken for pypdf, fall back to the size pdfinfo reports for the first page
+        print(f"Unexpected {err=}, {type(err)=}")
+    try:
+        width, height = [float(x) for x in re.findall(r'[\d.]+', pdf_info['Page size'])[:2]]
+    except (KeyError, ValueError):
+        width, height = 612, 792
+    return [(width, height)] * page_count
+
+
+def ocr_page_bytes(width, height, dpi):
+    return (width / 72 * dpi) * (height / 72 * dpi) * (1 if OCR_GRAYSCALE else 3)
+
+
+def ocr_windows(page_sizes):
+    """
+    (first page, last page, dpi) of the windows to render. A page too large for OCR_MEMORY_BUDGET at OCR_DPI is
+    rendered at the dpi that fits it, consecutive pages at the same dpi share a window as long as they fit together
+    """
+    windows = []
+    window_bytes = 0
+    for page_number, (width, height) in enumerate(page_sizes, start=1):
+        dpi = OCR_DPI
+        if ocr_page_bytes(width, height, dpi) > OCR_MEMORY_BUDGET:
+            dpi = max(1, int(OCR_DPI * (OCR_MEMORY_BUDGET / ocr_page_bytes(width, height, OCR_DPI)) ** 0.5))
+            print(f'page {page_number} is {width:.0f}x{height:.0f} pt, rendered at {dpi} dpi')
+        page_bytes = ocr_page_bytes(width, height, dpi)
+        if windows and windows[-1][2] == dpi and window_bytes + page_bytes <= OCR_MEMORY_BUDGET:
+            windows[-1][1] = page_number
+            window_bytes += page_bytes
+        else:
+            windows.append([page_number, page_number, dpi])
+            window_bytes = page_bytes
+    return windows
+
+
+def ocr_streaming(pdf_path, max_pages=None):
+    from pdf2image import convert_from_path, pdfinfo_from_path
+    pdf_info = pdfinfo_from_path(pdf_path)
+    page_count = pdf_info['Pages']
+    if page_count > OCR_MAX_PAGES:
+        print(f'{page_count} pages, only the first {OCR_MAX_PAGES} are read')
+        page_count = OCR_MAX_PAGES
+    if max_pages is not None:
+        page_count = min(page_count, max_pages)
+
+    page_list = []
+    languages = None
+    for first_page, last_page, dpi in ocr_windows(ocr_page_sizes(pdf_path, pdf_info, page_count)):
+        # ppm/pgm straight from pdftoppm, no lossy jpeg round trip
+        pages = convert_from_path(pdf_path, dpi=dpi, grayscale=OCR_GRAYSCALE,
+                                  first_page=first_page, last_page=last_page)
+        for page in pages:
+            if languages is None:
+                languages = ocr_engine.detect_languages(page)
+            page_list.append(ocr_engine.image_to_string(page, languages))
+            page.close()
+        del pages
+    return page_list
+
+
+def ocr(input_file, max_pages=None):
+    if OCR_STREAMING:
+        t0 = time.perf_counter()
+        if isinstance(input_file, str):
+            page_list = ocr_streaming(input_file, max_pages=max_pages)
+        else:
+            # write the pdf once, pdf2image would write it again for every window otherwise
+            with tempfile.TemporaryDirectory() as temp_dir:
+                pdf_path = os.path.join(temp_dir, 'input.pdf')
+                with open(pdf_path, 'wb') as f:
+                    f.write(input_file)
+                page_list = ocr_streaming(pdf_path, max_pages=max_pages)
+        t1 = time.perf_counter()
+        print('ocr time:', t1 - t0)
+        return page_list
+
     # pdf2jpeg
-    pages = convert_from_bytes(input_file, fmt='jpeg')
+    from pdf2image import convert_from_bytes, convert_from_path
+    if isinstance(input_file, str):
+        pages = convert_from_path(input_file, fmt='jpeg', last_page=max_pages)
+    else:
+        pages = convert_from_bytes(input_file, fmt='jpeg', last_page=max_pages)
 
     t0 = time.perf_counter()
     # jpg2txt
     page_list = []
+    languages = ocr_engine.detect_languages(pages[0]) if pages else None
     for page in pages:
-        page_text = pytesseract.image_to_string(page, lang='eng+chi_sim+kor')
+        page_text = ocr_engine.image_to_string(page, languages)
         page_list.append(page_text)
     t1 = time.perf_counter()
     print('jpg2text time:', t1 - t0)
@@ -153,8 +325,10 @@ def ocr(input_file):
 
 
 def extract_docx(input_file):
-    with docx2python(input_file) as docx_content:
-        return re.sub(r'\n+', '\n', docx_content.text)
+    from docx2python import docx2python
+    with open_source(input_file) as stream:
+        with docx2python(stream) as docx_content:
+            return re.sub(r'\n+', '\n', docx_content.text)
 
 # ----------------------------------------------------------------------------------------------------------------------
 
@@ -168,22 +342,14 @@ def parse_one_pass(input_text):
     system_message = "You are an assistant designed to extract information. You always give detailed feedback." \
                      "Users will paste in a string " \
                      "and you will return a JSON file. The format of the JSON file should be " \
-                     "[{\"name\": string, " \
-                     "\"gender\": string, \"birth year\": string, \"phone number\": string, \"email\": string, " \
-                     "\"desired salary:\": string, \"industry\": string, \"nationality\": string, " \
-                     "\"current country:\": string, \"current city:\": string}," \
-                     "{\"company name\": string, " \
-                     "\"position\": string, \"duration\": string, \"achievement\": string, \"responsibility\": string}," \
-                     "{\"school name\": string, " \
-                     "\"education_level\": string, \"major\": string, \"duration\": string}," \
-                     "{\"language spoken\": string, \"proficiency\": string}]"
+                     + ONE_PASS_SCHEMA.prompt(COMPACT_SCHEMA)
 
     total_message = system_message + '\n\n' + input_text
     with open('prompt.txt', 'w', encoding='utf-8') as f:
         f.write(total_message)
 
     response = chat_completion_with_backoff(
-        engine=GPT4Engine,
+        'one pass',
         messages=[
             {"role": "system", "content": system_message},
             {"role": "user", "content": "\n\"\"\"\n" + input_text}
@@ -199,8 +365,8 @@ def parse_one_pass(input_text):
     chat_ans = response['choices'][0]['message']['content']
     print(chat_ans)
 
-    # find the first occurrence of [
-    start_index = chat_ans.find('[')
+    # find the first occurrence of [, or { for the compact format
+    start_index = chat_ans.find('{' if COMPACT_SCHEMA else '[')
     chat_ans = chat_ans[start_index:]
 
     # print(chat_ans)
@@ -209,12 +375,12 @@ def parse_one_pass(input_text):
           response['usage']['completion_tokens'] * 0.06 / 1000 + response['usage']['prompt_tokens'] * 0.03 / 1000)
 
     try:
-        data = json.loads(chat_ans)
+        data = ONE_PASS_SCHEMA.expand(json.loads(chat_ans))
 
         # for element in data:
         #     for key, value in element.items():
         #         print("{}: {}".format(key, value))
-        return chat_ans
+        return json.dumps(data, ensure_ascii=False)
 
     except Exception as err:
         print(f"Unexpected {err=}, {type(err)=}")
@@ -239,48 +405,96 @@ http request.
 """
 
 
-async def post_separate(pages):
-    url = GPT35URL
+def page_system_message(compact):
+    return "You are an assistant designed to extract information." \
+           "Users will paste in a string " \
+           "and you will return a JSON file. The format of the JSON file should be " \
+           + PAGE_SCHEMA.prompt(compact) + \
+           "There can be more than one education and experience sections. "
 
-    system_message = "You are an assistant designed to extract information." \
-                     "Users will paste in a string " \
-                     "and you will return a JSON file. The format of the JSON file should be " \
-                     "{\"personal information\": " \
-                     "{\"name\":string, " \
-                     "\"gender\":string, \"birth year\":string, \"phone number\":string, \"email\":string, " \
-                     "\"desired salary:\":string, \"industry\":string, \"nationality\":string, " \
-                     "\"current country:\":string, \"current city:\":string}," \
-                     "\"experience\": " \
-                     "{\"company name\":string, " \
-                     "\"position\":string, \"duration\":string, \"achievement\":string, \"responsibility\":string}," \
-                     "\"education\": " \
-                     "{\"school name\":string, " \
-                     "\"education level\":string, \"major\":string, \"duration\":string}}," \
-                     "There can be more than one education and experience sections. "
-
-    async with aiohttp.ClientSession() as session:
-        async def post(page_text):
-            headers = {"Content-Type": "application/json", "api-key": openai.api_key,
-                       "Authorization": "Bearer " + openai.api_key}
-            messages = [{'role': 'system', 'content': system_message}, {'role': 'user', 'content': page_text}]
-            data = {
-                'messages': messages,
-                'top_p': 0.5,
-                'max_tokens': 1500,
-            }
-            async with session.post(url=url, headers=headers, json=data) as response:
-                return await response.json()
-
-        return await asyncio.gather(*[
-            post(page) for page in pages
-        ])
-
-
-def parse_separate(input_file):
+
+def expand_page_response(json_file):
+    """
+    rewrite a compact answer into the full keys that get_sections_and_merge expects
+    """
+    try:
+        message = json_file['choices'][0]['message']
+        data = json.loads(auto_complete_json_brackets(message['content']))
+        message['content'] = json.dumps(PAGE_SCHEMA.expand(data), ensure_ascii=False)
+    except Exception as err:
+        print('unable to expand response,', err)
+    return json_file
+
+
+def record_page_usage(json_file):
+    usage = json_file.get('usage') or {}
+    if 'completion_tokens' in usage:
+        llm_router.metrics.incr('pages parsed')
+        llm_router.metrics.incr('page completion tokens', usage['completion_tokens'])
+
+
+async def post_separate(pages, compact=None):
+    compact = COMPACT_SCHEMA if compact is None else compact
+    system_message = page_system_message(compact)
+
+    async def post(page_text):
+        messages = [{'role': 'system', 'content': system_message}, {'role': 'user', 'content': page_text}]
+        data = {
+            'messages': messages,
+            'top_p': 0.5,
+            'max_tokens': 1500,
+        }
+        try:
+            json_file = await llm_router.acomplete('page', data)
+        except Exception as err:
+            print(f"Unexpected {err=}, {type(err)=}")
+            return {'error': str(err)}
+        if is_parsed_page(json_file):
+            record_page_usage(json_file)
+            if compact:
+                expand_page_response(json_file)
+        return json_file
+
+    return await asyncio.gather(*[
+        post(page) for page in pages
+    ])
+
+
+def is_parsed_page(json_file):
+    return type(json_file) is dict and 'choices' in json_file
+
+
+async def post_separate_dedup(pages):
+    """
+    skip the pages of a near duplicate resume that were already parsed, and post the rest
+    """
+    # hashing is cpu bound, keep it off the event loop
+    fingerprint = await asyncio.to_thread(resume_index.fingerprint, pages)
+    match = resume_index.lookup(fingerprint)
+    if match is None:
+        json_list = await post_separate(pages)
+    elif NEAR_DUPLICATE_MODE == 'document' and all(is_parsed_page(result) for result in match.results):
+        json_list = match.results
+    else:
+        reusable = {idx: result for idx, result in resume_index.reusable_pages(fingerprint, match).items()
+                    if is_parsed_page(result)}
+        changed = [idx for idx in range(len(pages)) if idx not in reusable]
+        print('reused pages:', len(reusable), 'changed pages:', len(changed))
+        fresh = iter(await post_separate([pages[idx] for idx in changed]) if changed else [])
+        json_list = [reusable[idx] if idx in reusable else next(fresh) for idx in range(len(pages))]
+
+    if match is not None:
+        resume_index.remove(match.key)
+    resume_index.add(fingerprint, json_list)
+    return json_list
+
+
+async def parse_separate(input_file):
     try:
         # page_list = ocr(input_file)
-        page_list = extract(input_file)
-        json_list = post_separate(page_list)
+        # extraction waits on the pdf worker processes or runs the ocr, keep it off the event loop
+        page_list = await asyncio.to_thread(extract, input_file)
+        json_list = await post_separate_dedup(page_list)
         return json_list
 
     except Exception as err:
@@ -408,8 +622,8 @@ def get_sections_and_merge(json_list):
     employment_experience_all = []
     education_all = []
     for json_file in json_list:
-        print(json_file['choices'][0]['message']['content'])
         try:
+            print(json_file['choices'][0]['message']['content'])
             json_string = json_file['choices'][0]['message']['content']
             data = json.loads(auto_complete_json_brackets(json_string))
         except Exception as e:
@@ -473,7 +687,7 @@ def find_best_achievement(input_text):
     # "if you think the information is not enough, write \"lack information\" " \
 
     response = chat_completion_with_backoff(
-        engine=GPT35Engine,
+        'summary',
         messages=[
             {"role": "system", "content": system_message},
             {"role": "user", "content": "\n\"\"\"\n" + input_text}
@@ -502,7 +716,7 @@ def get_reference(input_text):
                      "Users will paste in a string. And you will try to extract referee and contact"
 
     response = chat_completion_with_backoff(
-        engine=GPT35Engine,
+        'reference',
         messages=[
             {"role": "system", "content": system_message},
             {"role": "user", "content": "\n\"\"\"\n" + input_text}
@@ -534,12 +748,69 @@ def read_root():
     }
 
 
+def warm_up_imports():
+    import numpy
+    import openai
+    import pypdf
+    import pdf2image
+    import docx2python
+    import pytesseract
+
+
+def warm_up_pdf_pool():
+    if PDF_PARALLEL_MIN_PAGES and PDF_WORKERS > 1:
+        pdf_text.warm_up(PDF_WORKERS)
+
+
+@app.on_event('startup')
+async def warm_up():
+    t0 = time.perf_counter()
+    steps = []
+    if 'imports' in WARMUP:
+        steps.append(asyncio.to_thread(warm_up_imports))
+    if 'http' in WARMUP:
+        steps.append(llm_router.warm_up())
+    if 'tessdata' in WARMUP:
+        steps.append(asyncio.to_thread(ocr_engine.installed_languages))
+    if 'pdf_pool' in WARMUP:
+        steps.append(asyncio.to_thread(warm_up_pdf_pool))
+    for result in await asyncio.gather(*steps, return_exceptions=True):
+        if isinstance(result, Exception):
+            print(f"warm up failed {result=}, {type(result)=}")
+    print('warm up time:', time.perf_counter() - t0)
+
+
+@app.on_event('shutdown')
+async def close_connections():
+    await llm_router.close()
+
+
+# api calls are interactive and go before bulk ingestion in the llm queues, unless they send "X-Priority: bulk"
+@app.middleware('http')
+async def set_llm_priority(request, call_next):
+    start_request(BULK if request.headers.get('x-priority', '').lower() == 'bulk' else INTERACTIVE)
+    return await call_next(request)
+
+
+# reject uploads over the limit while the body is read, before it is spooled. The margin is for the multipart framing
+# and the form fields of /cpr
+app.add_middleware(UploadSizeLimit, max_bytes=MAX_UPLOAD_BYTES + 64 * 1024)
+
+
+@app.get('/metrics')
+def read_metrics():
+    return {
+        'llm': llm_router.snapshot(),
+        'near duplicates': resume_index.metrics(),
+        'ocr': ocr_engine.metrics()
+    }
+
+
 # api call: resume file --> structured json
 @app.post('/parse')
 async def read_parse(file: UploadFile):
-    f = await file.read()
-
-    json_list = await parse_separate(f)
+    async with spooled_upload(file, MAX_UPLOAD_BYTES, UPLOAD_SPOOL_THRESHOLD, MAX_UPLOAD_PAGES) as f:
+        json_list = await parse_separate(f)
 
     personal_information_all, employment_experience_all, education_all = get_sections_and_merge(json_list)
     employment_experience_all = process_experience(employment_experience_all)
@@ -603,7 +874,7 @@ async def read_parse(file: UploadFile):
 async def summarize():
     with open("temp.txt", encoding='utf-8') as f:
         shortened_cv = f.read()
-    summary = find_best_achievement(shortened_cv)
+    summary = await asyncio.to_thread(find_best_achievement, shortened_cv)
     pattern = r'\d\.(.*)'
     points = re.findall(pattern=pattern, string=summary)
     print(points)
@@ -644,7 +915,7 @@ async def reference():
     with open('last_page.txt') as f:
         last_page = f.read()
         print(last_page)
-    reference_text = get_reference(last_page)
+    reference_text = await asyncio.to_thread(get_reference, last_page)
     return {
         "reference": reference_text
     }
@@ -667,8 +938,8 @@ async def get_cpr(file: Annotated[UploadFile, File()], client_info: Annotated[st
                   kpi: Annotated[str, Form()]='None', education: Annotated[str, Form()]='None',
                   skills: Annotated[str, Form()]='None', target_company: Annotated[str, Form()]='None',
                   industry_insider_advice: Annotated[str, Form()]='None'):
-    f = await file.read()
-    pages = extract(f)
+    async with spooled_upload(file, MAX_UPLOAD_BYTES, UPLOAD_SPOOL_THRESHOLD, MAX_UPLOAD_PAGES) as f:
+        pages = await asyncio.to_thread(extract, f)
     resume_text = '\n\n'.join(pages)
 
     system_message = "You are an excellent headhunter. You task is to recommend candidates to your clients."
@@ -690,8 +961,9 @@ async def get_cpr(file: Annotated[UploadFile, File()], client_info: Annotated[st
     with open("prompt.txt", 'w') as f:
         f.write(system_message)
 
-    response = chat_completion_with_backoff(
-        engine=GPT4Engine,
+    response = await asyncio.to_thread(
+        chat_completion_with_backoff,
+        'cpr',
         messages=[
             {"role": "system", "content": system_message},
             {"role": "user", "content": "\n\"\"\"\n" + user_message}
@@ -709,8 +981,15 @@ async def get_cpr(file: Annotated[UploadFile, File()], client_info: Annotated[st
 
     return chat_ans
 
-wsgi_app = ASGIMiddleware(app)
+def __getattr__(name):
+    # wsgi_app is only built when a wsgi server asks for it
+    if name == 'wsgi_app':
+        from a2wsgi import ASGIMiddleware
+        globals()['wsgi_app'] = ASGIMiddleware(app)
+        return globals()['wsgi_app']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 if __name__ == '__main__':
+    import uvicorn
     uvicorn.run("main:app", host="127.0.0.1", port=8000)
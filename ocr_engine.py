@@ -0,0 +1,189 @@
+import os
+import re
+import threading
+
+
+"""
+OCR with the smallest set of tesseract language packs a document needs.
+Loading eng+chi_sim+kor for every page is several times slower than eng alone, and most scanned CVs use one language.
+1. detect the scripts of the first page: tesseract OSD if osd.traineddata is installed, otherwise a script histogram
+   of a quick pass over a downscaled copy of the page
+2. OCR every page of the document with only the packs of the detected scripts that are installed. eng stays loaded
+   next to a CJK pack, Chinese and Korean CVs are full of English names, emails and company names
+3. a page whose text comes back empty or mostly unrecognised is detected again on its own
+Detecting once per document keeps the extra tesseract pass off the other pages.
+With tesserocr installed, the tesseract engines stay loaded and are reused per worker thread, otherwise every call
+goes through the pytesseract command line wrapper.
+"""
+
+_tesserocr = None
+
+
+def get_tesserocr():
+    # optional dependency, imported on first use. None if it is not installed
+    global _tesserocr
+    if _tesserocr is None:
+        try:
+            import tesserocr
+            _tesserocr = tesserocr
+        except ImportError:
+            _tesserocr = False
+    return _tesserocr or None
+
+SCRIPT_PATTERNS = {
+    'kor': re.compile(r'[\uac00-\ud7af\u1100-\u11ff\u3130-\u318f]'),
+    'chi_sim': re.compile(r'[\u4e00-\u9fff\u3400-\u4dbf]'),
+    'eng': re.compile(r'[A-Za-z]'),
+}
+
+CJK_LANGUAGES = ('chi_sim', 'chi_tra', 'kor', 'jpn')
+# characters expected in the text of any script: digits and the punctuation of phone numbers, emails and dates
+COMMON_CHARACTERS = re.compile(r'[0-9.,:;\-/()@+&%#\'"]')
+
+# scripts reported by tesseract OSD
+OSD_SCRIPTS = {
+    'Latin': 'eng',
+    'Han': 'chi_sim',
+    'HanS': 'chi_sim',
+    'Hangul': 'kor',
+    'Korean': 'kor',
+}
+
+
+class OcrEngine:
+    """
+    languages: the packs a page may need, e.g. 'eng+chi_sim+kor'. Packs missing from tessdata are skipped
+    detect: detect the languages of a document instead of always loading all of them
+    detect_scale: size of the downscaled copy used for the script histogram
+    min_script_share: share of the recognized characters a script needs for its pack to be loaded
+    min_recognized_share: a page with less of its characters in the scripts of the document is detected again
+    """
+
+    def __init__(self, languages='eng+chi_sim+kor', tessdata_dir=None, detect=True, detect_scale=0.35,
+                 min_script_share=0.1, min_recognized_share=0.6):
+        self.languages = languages.split('+')
+        self.tessdata_dir = tessdata_dir
+        self.detect = detect
+        self.detect_scale = detect_scale
+        self.min_script_share = min_script_share
+        self.min_recognized_share = min_recognized_share
+        self._installed = None
+        self._local = threading.local()
+        self.lock = threading.Lock()
+        self.pages_per_language = {}
+        self.redetected_pages = 0
+
+    def get_tessdata_dir(self):
+        return self.tessdata_dir or os.environ.get('TESSDATA_PREFIX', '')
+
+    def installed_languages(self):
+        if self._installed is None:
+            tessdata_dir = self.get_tessdata_dir()
+            try:
+                installed = {name[:-len('.traineddata')] for name in os.listdir(tessdata_dir)
+                             if name.endswith('.traineddata')}
+            except OSError:
+                import pytesseract
+                installed = set(pytesseract.get_languages())
+            missing = [lang for lang in self.languages if lang not in installed]
+            if missing:
+                print('tesseract language packs not installed, skipping:', missing)
+            self._installed = installed
+        return self._installed
+
+    def usable_languages(self):
+        usable = [lang for lang in self.languages if lang in self.installed_languages()]
+        return usable or ['eng']
+
+    def _engine(self, lang):
+        # one engine per language set and worker thread, loaded on first use and reused after that
+        engines = getattr(self._local, 'engines', None)
+        if engines is None:
+            engines = self._local.engines = {}
+        if lang not in engines:
+            engines[lang] = get_tesserocr().PyTessBaseAPI(path=self.get_tessdata_dir(), lang=lang)
+        return engines[lang]
+
+    def _image_to_string(self, image, lang):
+        if get_tesserocr() is not None:
+            engine = self._engine(lang)
+            engine.SetImage(image)
+            return engine.GetUTF8Text()
+        import pytesseract
+        return pytesseract.image_to_string(image, lang=lang)
+
+    def _detect_with_osd(self, image):
+        import pytesseract
+        osd = pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT)
+        lang = OSD_SCRIPTS.get(osd.get('script'))
+        return [lang] if lang else []
+
+    def _detect_with_histogram(self, image, usable):
+        small = image.resize((max(1, int(image.width * self.detect_scale)),
+                              max(1, int(image.height * self.detect_scale))))
+        text = self._image_to_string(small, '+'.join(usable))
+        counts = {lang: len(SCRIPT_PATTERNS[lang].findall(text)) for lang in usable if lang in SCRIPT_PATTERNS}
+        total = sum(counts.values())
+        if not total:
+            return []
+        return [lang for lang, count in counts.items() if count / total >= self.min_script_share]
+
+    def detect_languages(self, image):
+        usable = self.usable_languages()
+        if not self.detect or len(usable) == 1:
+            return usable
+        try:
+            if 'osd' in self.installed_languages():
+                detected = self._detect_with_osd(image)
+            else:
+                detected = self._detect_with_histogram(image, usable)
+        except Exception as err:
+            print(f"Unexpected {err=}, {type(err)=}")
+            detected = []
+        if 'eng' not in detected and any(lang in CJK_LANGUAGES for lang in detected):
+            detected.append('eng')
+        detected = [lang for lang in usable if lang in detected]
+        return detected or usable
+
+    def recognized_share(self, text, languages):
+        # share of the characters that belong to the scripts of the languages, low when the wrong packs were loaded
+        characters = [c for c in text if not c.isspace()]
+        if not characters:
+            return 0.0
+        patterns = [SCRIPT_PATTERNS[lang] for lang in languages if lang in SCRIPT_PATTERNS] + [COMMON_CHARACTERS]
+        return sum(1 for c in characters if any(pattern.match(c) for pattern in patterns)) / len(characters)
+
+    def image_to_string(self, image, languages=None):
+        """
+        languages: packs detected on an earlier page of the same document, detected on this page if None. The page
+                   is detected again when its text comes back empty or mostly unrecognised with them
+        """
+        if not languages:
+            languages = self.detect_languages(image)
+        elif self.detect:
+            text = self._image_to_string(image, '+'.join(languages))
+            if self.recognized_share(text, languages) >= self.min_recognized_share:
+                self._count(languages)
+                return text
+            page_languages = self.detect_languages(image)
+            if set(page_languages) == set(languages):
+                self._count(languages)
+                return text
+            with self.lock:
+                self.redetected_pages += 1
+            languages = page_languages
+        self._count(languages)
+        return self._image_to_string(image, '+'.join(languages))
+
+    def _count(self, languages):
+        lang = '+'.join(languages)
+        with self.lock:
+            self.pages_per_language[lang] = self.pages_per_language.get(lang, 0) + 1
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'engine': 'tesserocr' if get_tesserocr() is not None else 'pytesseract',
+                'pages per language': dict(self.pages_per_language),
+                'pages detected again': self.redetected_pages
+            }
@@ -0,0 +1,112 @@
+import concurrent.futures
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+
+from upload import open_source
+
+
+"""
+Text layer extraction of long pdfs across a process pool. pypdf is pure python, so a long and font heavy document
+(portfolio, publication list) takes seconds on one core. The page range is split into one contiguous range per
+worker, each worker opens the document once from the file (memory mapped) and the pages come back in order.
+Kept out of main.py so that the worker processes do not import the whole app.
+"""
+
+_executor = None
+_executor_workers = 0
+
+
+def clean_page_text(para):
+    para = re.sub(r'\n+', '\n', para)
+    para = re.sub(r' +', ' ', para)
+    return para
+
+
+def extract_page_range(source, start, stop):
+    from pypdf import PdfReader
+    with open_source(source) as stream:
+        reader = PdfReader(stream)
+        return [clean_page_text(reader.pages[idx].extract_text()) for idx in range(start, stop)]
+
+
+def get_executor(workers):
+    global _executor, _executor_workers
+    if _executor is None or _executor_workers != workers:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        # not fork: the app runs threads (uvicorn, asyncio.to_thread) whose locks a forked child would inherit, and
+        # forked workers would carry the whole app. forkserver and spawn children start from a fresh interpreter
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('forkserver')
+            # the fork server imports pypdf once and every worker is forked from it with pypdf loaded
+            mp_context.set_forkserver_preload(['pdf_text', 'pypdf'])
+        else:
+            mp_context = multiprocessing.get_context('spawn')
+        _executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+        _executor_workers = workers
+    return _executor
+
+
+def reset_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _import_pypdf():
+    import pypdf
+
+
+def warm_up(workers):
+    # start the worker processes and have them import pypdf before the first long pdf comes in
+    executor = get_executor(workers)
+    for future in [executor.submit(_import_pypdf) for _ in range(workers)]:
+        future.result()
+
+
+def split_pages(page_count, workers):
+    chunk, extra = divmod(page_count, workers)
+    ranges = []
+    start = 0
+    for idx in range(workers):
+        stop = start + chunk + (1 if idx < extra else 0)
+        if stop > start:
+            ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def extract_parallel(input_file, page_count, workers):
+    """
+    text of the first page_count pages, input_file is the pdf as bytes or the path of a spooled upload
+    """
+    workers = max(1, min(workers, page_count))
+    temp_dir = None
+    try:
+        if isinstance(input_file, str):
+            path = input_file
+        else:
+            # the workers share one file instead of each getting a pickled copy of the bytes
+            temp_dir = tempfile.mkdtemp()
+            path = os.path.join(temp_dir, 'input.pdf')
+            with open(path, 'wb') as f:
+                f.write(input_file)
+
+        ranges = split_pages(page_count, workers)
+        try:
+            results = get_executor(workers).map(extract_page_range, [path] * len(ranges),
+                                                [start for start, _ in ranges], [stop for _, stop in ranges])
+            return [page for pages in results for page in pages]
+        except concurrent.futures.process.BrokenProcessPool as err:
+            # a worker died (oom killed, crashed): the pool is unusable from now on. The next call starts a new one,
+            # this one is read in process
+            print(f"Unexpected {err=}, {type(err)=}")
+            reset_executor()
+            return extract_page_range(path, 0, page_count)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
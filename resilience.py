@@ -0,0 +1,236 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    stop_after_attempt,
+    wait_random_exponential,
+    retry_if_exception_type
+)
+
+
+"""
+Resilience helpers shared by the llm clients:
+1. Deadline: a latency budget per request that retries, waits and timeouts have to fit in
+2. CircuitBreaker: fail fast while the error rate of an endpoint is too high
+3. LatencyTracker + hedge: send a duplicate request when the first one is slower than the p95 latency
+4. Metrics: counters to see how all of the above behaves
+"""
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class TransientHTTPError(Exception):
+    def __init__(self, status, message=''):
+        super().__init__(f'http {status} {message}'.strip())
+        self.status = status
+
+
+class Deadline:
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, request_timeout):
+        # a single attempt never outlives the budget of the whole request
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceededError(f'latency budget of {self.budget}s exceeded')
+        return min(request_timeout, remaining)
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class CircuitBreaker:
+    """
+    closed: calls go through, the outcome of the last `window` calls is kept
+    open: the failure rate went over `failure_rate`, calls fail fast for `cooldown` seconds
+    half open: after the cooldown, one trial call decides whether to close or open again
+    """
+
+    def __init__(self, name='llm', failure_rate=0.5, window=20, min_calls=5, cooldown=30, metrics=None):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.lock = threading.Lock()
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = 'half open'
+                self.trial_running = False
+            if self.state == 'closed':
+                return
+            if self.state == 'half open' and not self.trial_running:
+                self.trial_running = True
+                return
+            self.metrics.incr('short_circuited')
+            raise CircuitOpenError(f'circuit breaker {self.name} is {self.state}')
+
+    def release_trial(self):
+        # the trial call ended without an outcome (cancelled), let the next call be the trial
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self.lock:
+            self.outcomes.append(True)
+            if self.state == 'half open':
+                print(f'circuit breaker {self.name} closed')
+                self.state = 'closed'
+                self.outcomes.clear()
+
+    def record_failure(self):
+        with self.lock:
+            self.outcomes.append(False)
+            failures = self.outcomes.count(False)
+            if self.state == 'half open' or (self.state == 'closed' and len(self.outcomes) >= self.min_calls
+                                             and failures / len(self.outcomes) >= self.failure_rate):
+                print(f'circuit breaker {self.name} opened, {failures} failures in the last {len(self.outcomes)} calls')
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.metrics.incr('breaker_opened')
+
+    def is_available(self):
+        with self.lock:
+            return self.state == 'closed' or time.monotonic() - self.opened_at >= self.cooldown
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'recent calls': len(self.outcomes),
+                'recent failures': self.outcomes.count(False)
+            }
+
+
+class LatencyTracker:
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p, min_samples=1):
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+async def hedge(make_call, delay, metrics=None):
+    """
+    await make_call(); if it has not finished after `delay` seconds, start a duplicate and return whichever
+    succeeds first. `delay` None disables hedging
+    """
+    first = asyncio.ensure_future(make_call())
+    if delay is None:
+        return await first
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        if metrics is not None:
+            metrics.incr('hedged')
+        second = asyncio.ensure_future(make_call())
+        tasks.append(second)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            # read the exception of every finished call, even when the other one won
+            for task in done:
+                if task.cancelled():
+                    continue
+                if task.exception() is None:
+                    winner = winner or task
+                else:
+                    error = task.exception()
+            if winner is not None:
+                if metrics is not None and winner is second:
+                    metrics.incr('hedge_won')
+                return winner.result()
+        raise error or asyncio.CancelledError()
+    finally:
+        # the losing call, or every call when the caller itself is cancelled (client disconnect)
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def _stop_at_deadline(deadline, metrics):
+    def stop(retry_state):
+        if deadline.expired():
+            metrics.incr('deadline_exceeded')
+            return True
+        return False
+    return stop
+
+
+def _wait_within_deadline(deadline, max_wait):
+    wait = wait_random_exponential(multiplier=1, max=max_wait)
+
+    def wait_within(retry_state):
+        return min(wait(retry_state), deadline.remaining())
+    return wait_within
+
+
+def _count_retry(metrics):
+    def before_sleep(retry_state):
+        metrics.incr('retries')
+        print(f'retrying after {retry_state.outcome.exception()!r}')
+    return before_sleep
+
+
+def retrying(deadline, retry_on, max_attempts=10, max_wait=60, metrics=None, is_async=False):
+    """
+    tenacity retrying loop that stops after max_attempts or when the deadline is spent, whichever comes first
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    retrying_class = AsyncRetrying if is_async else Retrying
+    return retrying_class(
+        retry=retry_if_exception_type(retry_on),
+        wait=_wait_within_deadline(deadline, max_wait),
+        stop=stop_after_attempt(max_attempts) | _stop_at_deadline(deadline, metrics),
+        before_sleep=_count_retry(metrics),
+        reraise=True
+    )
@@ -0,0 +1,415 @@
+import asyncio
+import sys
+import threading
+import time
+
+from resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Deadline,
+    LatencyTracker,
+    Metrics,
+    TransientHTTPError,
+    hedge,
+    retrying
+)
+from scheduler import Scheduler, estimate_tokens
+
+
+"""
+Routing layer for the llm calls. Every backend (an azure deployment, the public openai api, a local openai compatible
+server) is registered with the task classes it may serve ('page', 'one pass', 'summary', 'reference', 'cpr').
+Each call goes to the healthy backend with the lowest expected latency for its task, and fails over to the next one.
+openai and aiohttp are imported on the first call of their path, not when the app starts.
+"""
+
+
+def retryable_openai_errors():
+    import openai
+    return (openai.error.APIError, openai.error.APIConnectionError, openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError, openai.error.Timeout)
+
+
+def retryable_http_errors():
+    import aiohttp
+    return aiohttp.ClientError, asyncio.TimeoutError, TransientHTTPError
+
+
+def is_timeout(err):
+    openai = sys.modules.get('openai')
+    return isinstance(err, asyncio.TimeoutError) or (openai is not None and isinstance(err, openai.error.Timeout))
+
+
+def is_transient(err):
+    # errors that say the backend is unhealthy, as opposed to the request itself being refused (invalid request,
+    # over the context length, bad credentials)
+    if isinstance(err, (asyncio.TimeoutError, TransientHTTPError)):
+        return True
+    openai = sys.modules.get('openai')
+    aiohttp = sys.modules.get('aiohttp')
+    return (openai is not None and isinstance(err, retryable_openai_errors())) or \
+        (aiohttp is not None and isinstance(err, aiohttp.ClientError))
+
+
+class NoBackendAvailableError(Exception):
+    pass
+
+
+class Backend:
+    """
+    kind: 'azure' (deployment + api_base + api_version), 'openai' (model) or 'local' (model + api_base of an
+          openai compatible server)
+    url: full chat completion url for the http path, built from the other values if empty
+    tasks: task classes this backend may serve
+    tokens_per_minute, requests_per_minute: quota of the deployment, enforced by the scheduler. None for no limit
+    """
+
+    def __init__(self, name, kind='azure', tasks=(), deployment='', model='', api_base='', api_key='',
+                 api_version='', organization='', url='', tokens_per_minute=None, requests_per_minute=None):
+        if kind not in ('azure', 'openai', 'local'):
+            raise ValueError(f'unknown backend kind {kind}')
+        self.name = name
+        self.kind = kind
+        self.tasks = tuple(tasks)
+        self.deployment = deployment
+        self.model = model
+        self.api_base = api_base or ('https://api.openai.com/v1' if kind == 'openai' else '')
+        self.api_key = api_key
+        self.api_version = api_version
+        self.organization = organization
+        self.url = url
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+
+        self.latency_ewma = None
+        self.in_flight = 0
+        self.rate_limited_until = 0.0
+        self.quota = {}
+        self.breaker = None
+        self.lock = threading.Lock()
+
+    def sdk_kwargs(self):
+        if self.kind == 'azure':
+            return {'engine': self.deployment, 'api_type': 'azure', 'api_base': self.api_base,
+                    'api_version': self.api_version, 'api_key': self.api_key}
+        kwargs = {'model': self.model, 'api_type': 'open_ai', 'api_base': self.api_base,
+                  'api_key': self.api_key or 'local'}
+        if self.organization:
+            kwargs['organization'] = self.organization
+        return kwargs
+
+    def http_url(self):
+        if self.url:
+            return self.url
+        if self.kind == 'azure':
+            return f'{self.api_base.rstrip("/")}/openai/deployments/{self.deployment}/chat/completions' \
+                   f'?api-version={self.api_version}'
+        return self.api_base.rstrip('/') + '/chat/completions'
+
+    def http_headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.kind == 'azure':
+            headers["api-key"] = self.api_key
+        headers["Authorization"] = "Bearer " + (self.api_key or 'local')
+        if self.organization:
+            headers["OpenAI-Organization"] = self.organization
+        return headers
+
+    def http_payload(self, data):
+        if self.kind == 'azure':
+            return data
+        return {'model': self.model, **data}
+
+    def record_latency(self, seconds, alpha):
+        with self.lock:
+            if self.latency_ewma is None:
+                self.latency_ewma = seconds
+            else:
+                self.latency_ewma = alpha * seconds + (1 - alpha) * self.latency_ewma
+
+    def record_rate_limit(self, retry_after, default_cooldown):
+        try:
+            cooldown = float(retry_after)
+        except (TypeError, ValueError):
+            cooldown = default_cooldown
+        with self.lock:
+            self.rate_limited_until = max(self.rate_limited_until, time.monotonic() + cooldown)
+
+    def record_quota(self, headers):
+        if not headers:
+            return
+        with self.lock:
+            for key in ('x-ratelimit-remaining-requests', 'x-ratelimit-remaining-tokens'):
+                if key in headers:
+                    self.quota[key] = headers[key]
+
+    def is_rate_limited(self):
+        return time.monotonic() < self.rate_limited_until
+
+    def expected_latency(self):
+        # untried backends go first, busy backends look slower so that the load spreads across deployments
+        with self.lock:
+            return (self.latency_ewma or 0.0) * (1 + self.in_flight)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'kind': self.kind,
+                'tasks': list(self.tasks),
+                'latency ewma': self.latency_ewma,
+                'in flight': self.in_flight,
+                'rate limited for': max(0.0, self.rate_limited_until - time.monotonic()),
+                'quota': dict(self.quota),
+                'circuit breaker': self.breaker.snapshot() if self.breaker else None
+            }
+
+
+class Router:
+    def __init__(self, latency_budget=120, request_timeout=60, max_attempts=10, max_backoff=60,
+                 breaker_failure_rate=0.5, breaker_window=20, breaker_min_calls=5, breaker_cooldown=30,
+                 hedge_percentile=95, hedge_min_samples=20, ewma_alpha=0.3, rate_limit_cooldown=10, scheduler=None,
+                 connection_limit=100):
+        self.latency_budget = latency_budget
+        self.request_timeout = request_timeout
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.breaker_settings = {'failure_rate': breaker_failure_rate, 'window': breaker_window,
+                                 'min_calls': breaker_min_calls, 'cooldown': breaker_cooldown}
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.ewma_alpha = ewma_alpha
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.backends = {}
+        self.latency = {}
+        self.metrics = Metrics()
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.session = None
+        self.session_loop = None
+        self.connection_limit = connection_limit
+
+    def register(self, backend):
+        backend.breaker = CircuitBreaker(name=backend.name, metrics=self.metrics, **self.breaker_settings)
+        self.scheduler.configure(backend.name, backend.tokens_per_minute, backend.requests_per_minute)
+        self.backends[backend.name] = backend
+        return backend
+
+    def remove(self, name):
+        self.scheduler.configure(name)
+        return self.backends.pop(name, None)
+
+    def candidates(self, task):
+        """
+        backends allowed for the task with a closed breaker, fastest first. Rate limited ones go last
+        """
+        allowed = [backend for backend in self.backends.values() if task in backend.tasks]
+        if not allowed:
+            raise NoBackendAvailableError(f'no backend registered for task {task}')
+        healthy = [backend for backend in allowed if backend.breaker.is_available()]
+        if not healthy:
+            self.metrics.incr('short_circuited')
+            raise NoBackendAvailableError(f'all backends for task {task} are failing')
+        return sorted(healthy, key=lambda backend: (backend.is_rate_limited(), backend.expected_latency()))
+
+    def task_latency(self, task):
+        return self.latency.setdefault(task, LatencyTracker())
+
+    def _start(self, backend):
+        backend.breaker.allow()
+        self.metrics.incr('calls')
+        self.metrics.incr(f'calls {backend.name}')
+        with backend.lock:
+            backend.in_flight += 1
+        return time.perf_counter()
+
+    def _finish(self, backend, task, t0, err=None, rejected=False):
+        with backend.lock:
+            backend.in_flight -= 1
+        if rejected or (err is not None and not is_transient(err)):
+            # the backend answered and refused the request, neither a failure for the breaker nor a latency sample
+            self.metrics.incr('rejected')
+            backend.breaker.release_trial()
+            return
+        if err is None:
+            elapsed = time.perf_counter() - t0
+            backend.breaker.record_success()
+            backend.record_latency(elapsed, self.ewma_alpha)
+            self.task_latency(task).record(elapsed)
+            return
+        self.metrics.incr('failures')
+        self.metrics.incr(f'failures {backend.name}')
+        # a failed call counts as a timed out one, so that the backend falls behind the ones that answer
+        backend.record_latency(self.request_timeout, self.ewma_alpha)
+        if is_timeout(err):
+            self.metrics.incr('timeouts')
+        backend.breaker.record_failure()
+
+    """
+    sync path, through the openai sdk
+    """
+
+    def _create(self, backend, task, deadline, kwargs):
+        import openai
+        self.scheduler.acquire(backend.name, estimate_tokens(kwargs.get('messages', []), kwargs.get('max_tokens')),
+                               deadline)
+        request_timeout = deadline.timeout(self.request_timeout)
+        t0 = self._start(backend)
+        try:
+            response = openai.ChatCompletion.create(request_timeout=request_timeout, **backend.sdk_kwargs(), **kwargs)
+        except Exception as err:
+            self._finish(backend, task, t0, err)
+            if isinstance(err, openai.error.RateLimitError):
+                backend.record_rate_limit((err.headers or {}).get('Retry-After'), self.rate_limit_cooldown)
+            raise
+        self._finish(backend, task, t0)
+        return response
+
+    def _complete_round(self, task, deadline, kwargs):
+        last_error = None
+        for backend in self.candidates(task):
+            try:
+                return self._create(backend, task, deadline, kwargs)
+            except retryable_openai_errors() + (CircuitOpenError,) as err:
+                print(f'{backend.name} failed, {err!r}')
+                last_error = err
+                self.metrics.incr('failovers')
+        raise last_error
+
+    def complete(self, task, **kwargs):
+        deadline = Deadline(self.latency_budget)
+        for attempt in retrying(deadline, retryable_openai_errors(), max_attempts=self.max_attempts,
+                                max_wait=self.max_backoff, metrics=self.metrics):
+            with attempt:
+                return self._complete_round(task, deadline, kwargs)
+
+    """
+    async path, plain http requests through aiohttp
+    """
+
+    def get_session(self):
+        # one connection pool for all backends, created on the first call or by warm_up. A session belongs to the event
+        # loop that created it, scripts calling asyncio.run() more than once get a new one for every loop
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session_loop is not loop:
+            self._drop_session()
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connection_limit))
+            self.session_loop = loop
+        return self.session
+
+    async def warm_up(self, timeout=5):
+        """
+        create the connection pool and open a connection to every backend, so the first call skips dns and tls
+        """
+        import aiohttp
+        session = self.get_session()
+
+        async def connect(backend):
+            url = backend.http_url()
+            if not url:
+                return
+            try:
+                async with session.head(url, timeout=aiohttp.ClientTimeout(total=timeout)):
+                    pass
+            except Exception as err:
+                print(f'warm up of {backend.name} failed, {err!r}')
+
+        await asyncio.gather(*[connect(backend) for backend in self.backends.values()])
+
+    def _drop_session(self):
+        # the loop of the session is gone, there is nothing to await: close its connections right away. _close() is
+        # the synchronous part of connector.close(), calling close() without awaiting it is deprecated
+        if self.session is not None and not self.session.closed:
+            connector = self.session.connector
+            self.session.detach()
+            connector._close()
+
+    async def close(self):
+        if self.session is None or self.session.closed:
+            return
+        if self.session_loop is asyncio.get_running_loop():
+            await self.session.close()
+        else:
+            self._drop_session()
+
+    async def _post(self, session, backend, task, data, deadline):
+        await self.scheduler.aacquire(backend.name, estimate_tokens(data['messages'], data.get('max_tokens')),
+                                      deadline)
+        return await self._send(session, backend, task, data, deadline)
+
+    async def _send(self, session, backend, task, data, deadline):
+        import aiohttp
+        timeout = aiohttp.ClientTimeout(total=deadline.timeout(self.request_timeout))
+        t0 = self._start(backend)
+        try:
+            async with session.post(url=backend.http_url(), headers=backend.http_headers(),
+                                    json=backend.http_payload(data), timeout=timeout) as response:
+                backend.record_quota(response.headers)
+                if response.status == 429:
+                    backend.record_rate_limit(response.headers.get('Retry-After'), self.rate_limit_cooldown)
+                if response.status == 429 or response.status >= 500:
+                    raise TransientHTTPError(response.status, await response.text())
+                result = await response.json()
+                # 4xx, the error body goes back to the caller as before
+                rejected = response.status >= 400
+        except asyncio.CancelledError:
+            # the other request of a hedged pair won, or the client went away
+            with backend.lock:
+                backend.in_flight -= 1
+            backend.breaker.release_trial()
+            raise
+        except Exception as err:
+            self._finish(backend, task, t0, err)
+            raise
+        self._finish(backend, task, t0, rejected=rejected)
+        return result
+
+    async def _acomplete_round(self, session, task, data, deadline):
+        candidates = self.candidates(task)
+        tried = []
+
+        hedge_delay = None
+        if self.hedge_percentile:
+            hedge_delay = self.task_latency(task).percentile(self.hedge_percentile, self.hedge_min_samples)
+
+        last_error = None
+        while len(tried) < len(candidates):
+            backend = next(b for b in candidates if b not in tried)
+            tried.append(backend)
+            # the hedge delay counts from the moment the scheduler lets the call go, time spent in the queue of a
+            # rate limited deployment is not a slow response and a duplicate would only make the queue longer
+            await self.scheduler.aacquire(backend.name, estimate_tokens(data['messages'], data.get('max_tokens')),
+                                          deadline)
+            sent = []
+
+            def next_call():
+                if not sent:
+                    sent.append(backend)
+                    return self._send(session, backend, task, data, deadline)
+                # a hedged duplicate goes to the next backend in line, or the same one if there is only one
+                duplicate = next((b for b in candidates if b not in tried), candidates[-1])
+                tried.append(duplicate)
+                return self._post(session, duplicate, task, data, deadline)
+
+            try:
+                return await hedge(next_call, hedge_delay, metrics=self.metrics)
+            except retryable_http_errors() + (CircuitOpenError,) as err:
+                print(f'{tried[-1].name} failed, {err!r}')
+                last_error = err
+                self.metrics.incr('failovers')
+        raise last_error
+
+    async def acomplete(self, task, data, session=None):
+        session = session or self.get_session()
+        deadline = Deadline(self.latency_budget)
+        async for attempt in retrying(deadline, retryable_http_errors(), max_attempts=self.max_attempts,
+                                      max_wait=self.max_backoff, metrics=self.metrics, is_async=True):
+            with attempt:
+                return await self._acomplete_round(session, task, data, deadline)
+
+    def snapshot(self):
+        return {
+            'metrics': self.metrics.snapshot(),
+            'latency p95': {task: tracker.percentile(95) for task, tracker in self.latency.items()},
+            'scheduler': self.scheduler.snapshot(),
+            'backends': {name: backend.snapshot() for name, backend in self.backends.items()}
+        }
@@ -0,0 +1,212 @@
+import asyncio
+import contextvars
+import itertools
+import threading
+import time
+
+from resilience import DeadlineExceededError, LatencyTracker, Metrics
+
+
+"""
+Process wide scheduler for the llm calls. Every backend with a quota gets two token buckets, one for the estimated
+tokens per minute and one for the requests per minute. Calls wait in a queue per backend, ordered by
+1. priority class: interactive requests (/parse, /cpr ...) before bulk ingestion
+2. fair share: the request that got the fewest calls through so far goes first, so a 40 page resume does not hold
+   back a 2 page one that arrived later
+3. arrival order
+"""
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+# set per api request, calls made outside of an api request (scripts, batch jobs) count as bulk
+llm_priority = contextvars.ContextVar('llm_priority', default=BULK)
+llm_request_id = contextvars.ContextVar('llm_request_id', default=None)
+_request_ids = itertools.count()
+
+
+def start_request(priority):
+    llm_priority.set(priority)
+    llm_request_id.set(next(_request_ids))
+
+
+def estimate_tokens(messages, max_tokens):
+    # ~4 characters per token, plus the completion budget, which is also how azure counts a call against the quota
+    return sum(len(message.get('content') or '') for message in messages) // 4 + (max_tokens or 0)
+
+
+class TokenBucket:
+    """
+    burst_seconds: the bucket holds this many seconds of the quota. Azure enforces the per minute quotas over 1-10 s
+                   windows, so a full minute of burst after an idle period still gets 429s
+    """
+
+    def __init__(self, per_minute, burst_seconds=10):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * min(burst_seconds, 60)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_until(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        # a call bigger than the burst goes once the bucket is full and leaves it in debt, so the quota still holds
+        self._refill()
+        self.tokens -= amount
+
+
+class Lane:
+    def __init__(self, tokens_per_minute, requests_per_minute, burst_seconds=10):
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+
+    def time_until(self, tokens):
+        return max(self.tokens.time_until(tokens) if self.tokens else 0.0,
+                   self.requests.time_until(1) if self.requests else 0.0)
+
+    def take(self, tokens):
+        if self.tokens:
+            self.tokens.take(tokens)
+        if self.requests:
+            self.requests.take(1)
+
+
+class Waiter:
+    def __init__(self, key, tokens, priority, request_id, seq):
+        self.key = key
+        self.tokens = tokens
+        self.priority = priority
+        self.request_id = request_id
+        self.seq = seq
+        self.queued_at = time.monotonic()
+
+
+class Scheduler:
+    def __init__(self, poll_interval=0.05, burst_seconds=10):
+        self.poll_interval = poll_interval
+        self.burst_seconds = burst_seconds
+        self.lanes = {}
+        self.waiters = []
+        self.served = {}
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.metrics = Metrics()
+        self.wait_times = {priority: LatencyTracker() for priority in PRIORITY_NAMES}
+        self.max_depth = {}
+
+    def configure(self, key, tokens_per_minute=None, requests_per_minute=None):
+        with self.cond:
+            if tokens_per_minute or requests_per_minute:
+                self.lanes[key] = Lane(tokens_per_minute, requests_per_minute, self.burst_seconds)
+            else:
+                self.lanes.pop(key, None)
+
+    def _order(self, waiter):
+        return waiter.priority, self.served.get((waiter.key, waiter.request_id), 0), waiter.seq
+
+    def _enqueue(self, key, tokens, priority, request_id):
+        waiter = Waiter(key, tokens, llm_priority.get() if priority is None else priority,
+                        llm_request_id.get() if request_id is None else request_id, next(self.seq))
+        self.waiters.append(waiter)
+        depth = sum(1 for w in self.waiters if w.key == key)
+        self.max_depth[key] = max(self.max_depth.get(key, 0), depth)
+        return waiter
+
+    def _dequeue(self, waiter):
+        self.waiters.remove(waiter)
+        served_key = (waiter.key, waiter.request_id)
+        if not any((w.key, w.request_id) == served_key for w in self.waiters):
+            self.served.pop(served_key, None)
+
+    def _try_grant(self, waiter):
+        """
+        0 if the waiter got its capacity, otherwise seconds to wait before trying again
+        """
+        head = min((w for w in self.waiters if w.key == waiter.key), key=self._order)
+        if head is not waiter:
+            return self.poll_interval
+        wait = self.lanes[waiter.key].time_until(waiter.tokens)
+        if wait > 0:
+            return wait
+
+        self.lanes[waiter.key].take(waiter.tokens)
+        served_key = (waiter.key, waiter.request_id)
+        self.served[served_key] = self.served.get(served_key, 0) + 1
+        self._dequeue(waiter)
+        waited = time.monotonic() - waiter.queued_at
+        self.wait_times[waiter.priority].record(waited)
+        self.metrics.incr(f'granted {PRIORITY_NAMES[waiter.priority]}')
+        self.metrics.incr(f'tokens {waiter.key}', waiter.tokens)
+        return 0
+
+    def _give_up(self, waiter, deadline):
+        self._dequeue(waiter)
+        self.cond.notify_all()
+        self.metrics.incr(f'timed out {PRIORITY_NAMES[waiter.priority]}')
+        raise DeadlineExceededError(f'waited {deadline.budget}s for llm capacity on {waiter.key}')
+
+    def acquire(self, key, tokens, deadline, priority=None, request_id=None):
+        with self.cond:
+            if key not in self.lanes:
+                return
+            waiter = self._enqueue(key, tokens, priority, request_id)
+            while True:
+                wait = self._try_grant(waiter)
+                if wait == 0:
+                    self.cond.notify_all()
+                    return
+                if deadline.expired():
+                    self._give_up(waiter, deadline)
+                self.cond.wait(min(wait, deadline.remaining()))
+
+    async def aacquire(self, key, tokens, deadline, priority=None, request_id=None):
+        # same queue as acquire, but polls with asyncio.sleep instead of blocking the event loop
+        with self.cond:
+            if key not in self.lanes:
+                return
+            waiter = self._enqueue(key, tokens, priority, request_id)
+        try:
+            while True:
+                with self.cond:
+                    wait = self._try_grant(waiter)
+                    if wait == 0:
+                        self.cond.notify_all()
+                        return
+                    if deadline.expired():
+                        self._give_up(waiter, deadline)
+                await asyncio.sleep(min(wait, self.poll_interval, deadline.remaining()))
+        except asyncio.CancelledError:
+            with self.cond:
+                if waiter in self.waiters:
+                    self._dequeue(waiter)
+                    self.cond.notify_all()
+            raise
+
+    def snapshot(self):
+        with self.cond:
+            queues = {}
+            for key in self.lanes:
+                queued = [w for w in self.waiters if w.key == key]
+                queues[key] = {
+                    'queue depth': {name: sum(1 for w in queued if w.priority == priority)
+                                    for priority, name in PRIORITY_NAMES.items()},
+                    'max queue depth': self.max_depth.get(key, 0),
+                    'oldest wait': max((time.monotonic() - w.queued_at for w in queued), default=0.0)
+                }
+        return {
+            'metrics': self.metrics.snapshot(),
+            'wait p50': {name: self.wait_times[priority].percentile(50) for priority, name in PRIORITY_NAMES.items()},
+            'wait p95': {name: self.wait_times[priority].percentile(95) for priority, name in PRIORITY_NAMES.items()},
+            'queues': queues
+        }
@@ -0,0 +1,127 @@
+"""
+Output structures of the parsing prompts, defined once. Each structure generates
+1. the verbose prompt: the model echoes the full keys ("personal information", "desired salary:" ...) for every entry
+2. the compact prompt: the model answers with short aliased keys, which cuts the completion tokens, and so the
+   latency, of every page
+expand() turns a compact (or verbose) answer back into the public shape with the full keys.
+"""
+
+
+class Section:
+    """
+    key, alias: full and short name of the section
+    fields: (full key, alias) pairs
+    many: the section is a list of entries (experience, education) instead of a single one (personal information)
+    """
+
+    def __init__(self, key, alias, fields, many=False):
+        self.key = key
+        self.alias = alias
+        self.fields = fields
+        self.many = many
+
+    def verbose_entry(self):
+        return '{' + ', '.join(f'"{key}":string' for key, _ in self.fields) + '}'
+
+    def compact_entry(self):
+        return '{' + ', '.join(f'"{alias}":{key.rstrip(":")}' for key, alias in self.fields) + '}'
+
+    def expand_entry(self, entry):
+        if not isinstance(entry, dict):
+            return entry
+        expanded = {}
+        for key, alias in self.fields:
+            # the model sometimes falls back to the full keys, take either
+            value = entry.get(alias, entry.get(key))
+            if value is not None:
+                expanded[key] = value
+        return expanded
+
+    def expand(self, value):
+        if isinstance(value, list):
+            return [self.expand_entry(entry) for entry in value]
+        return self.expand_entry(value)
+
+
+class Schema:
+    """
+    as_list: the public shape is a list with one slot per section, in order (one pass parse), instead of an object
+             with one key per section. A slot is the entry of its section as in the verbose answer, {} when the
+             section is missing, or the list of entries when a many section has several
+    """
+
+    def __init__(self, sections, as_list=False):
+        self.sections = sections
+        self.as_list = as_list
+
+    def verbose_prompt(self):
+        if self.as_list:
+            return '[' + ','.join(section.verbose_entry() for section in self.sections) + ']'
+        return '{' + ','.join(f'"{section.key}": {section.verbose_entry()}' for section in self.sections) + '}'
+
+    def compact_prompt(self):
+        sections = ','.join(f'"{section.alias}":' + (f'[{section.compact_entry()}]' if section.many
+                                                      else section.compact_entry())
+                            for section in self.sections)
+        return '{' + sections + '} with exactly these short keys, as minified JSON without indentation. ' \
+                                'Use "" for missing values. '
+
+    def prompt(self, compact):
+        return self.compact_prompt() if compact else self.verbose_prompt()
+
+    def expand(self, data):
+        if self.as_list:
+            if isinstance(data, list):
+                # verbose answer, already in the public shape
+                return data
+            expanded = []
+            for section in self.sections:
+                value = section.expand(data.get(section.alias, data.get(section.key, {})))
+                if isinstance(value, list) and len(value) <= 1:
+                    value = value[0] if value else {}
+                expanded.append(value)
+            return expanded
+
+        if not isinstance(data, dict):
+            return data
+        expanded = {}
+        for section in self.sections:
+            value = data.get(section.alias, data.get(section.key))
+            if value is not None:
+                expanded[section.key] = section.expand(value)
+        return expanded
+
+    def compact(self, data):
+        """
+        inverse of expand for object schemas, to measure how many tokens the compact answers save
+        """
+        compacted = {}
+        for section in self.sections:
+            if section.key not in data:
+                continue
+            entries = data[section.key]
+            compact_entries = [{alias: entry[key] for key, alias in section.fields if key in entry}
+                               for entry in (entries if isinstance(entries, list) else [entries])]
+            compacted[section.alias] = compact_entries if section.many else compact_entries[0]
+        return compacted
+
+
+PERSONAL_INFORMATION = Section('personal information', 'p', [
+    ('name', 'n'), ('gender', 'g'), ('birth year', 'b'), ('phone number', 'ph'), ('email', 'em'),
+    ('desired salary:', 's'), ('industry', 'i'), ('nationality', 'na'), ('current country', 'co'),
+    ('current city', 'ci')
+])
+EXPERIENCE = Section('experience', 'x', [
+    ('company name', 'c'), ('position', 'p'), ('duration', 'd'), ('achievement', 'a'), ('responsibility', 'r')
+], many=True)
+EDUCATION = Section('education', 'e', [
+    ('school name', 's'), ('education level', 'l'), ('major', 'm'), ('duration', 'd')
+], many=True)
+LANGUAGE = Section('language', 'l', [
+    ('language spoken', 'l'), ('proficiency', 'p')
+], many=True)
+
+# one page of a resume, parsed by post_separate
+PAGE_SCHEMA = Schema([PERSONAL_INFORMATION, EXPERIENCE, EDUCATION])
+# the whole resume at once, parsed by parse_one_pass
+ONE_PASS_SCHEMA = Schema([PERSONAL_INFORMATION, EXPERIENCE, EDUCATION, LANGUAGE], as_list=True)
@@ -0,0 +1,128 @@
+import contextlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+
+
+"""
+Upload handling. Uploads are read in chunks and stay in memory up to a threshold, bigger ones are spooled to a temp
+file so that the extractors can read them from the path or a memory map instead of holding copies in memory.
+Byte and page limits are checked while reading, before any extraction starts, and the byte limit once more by
+UploadSizeLimit while the request body streams in.
+"""
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware: 413 for request bodies over max_bytes. Checked on Content-Length before the body is read, and
+    while the body streams in for chunked uploads without one, so the multipart parser never spools more than the
+    limit to disk
+    """
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        from fastapi import HTTPException
+        from fastapi.responses import JSONResponse
+        detail = f'upload is larger than {self.max_bytes} bytes'
+        content_length = dict(scope['headers']).get(b'content-length', b'')
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await JSONResponse(status_code=413, content={'detail': detail})(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_bytes:
+                    # raised inside the form parsing of the endpoint, which answers with the 413
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+@contextlib.contextmanager
+def open_source(input_file):
+    """
+    binary stream over an upload given as bytes or as the path of a spooled file
+    """
+    if isinstance(input_file, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(input_file)
+        return
+    with open(input_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield f
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def count_pdf_pages(input_file):
+    from pypdf import PdfReader
+    try:
+        with open_source(input_file) as stream:
+            return len(PdfReader(stream).pages)
+    except Exception:
+        # not a pdf (docx, or a broken pdf the ocr may still read)
+        return None
+
+
+@contextlib.asynccontextmanager
+async def spooled_upload(file, max_bytes, spool_threshold, max_pages=None, chunk_size=1024 * 1024):
+    """
+    yield the upload as bytes if it is smaller than spool_threshold, otherwise as the path of a temp file that is
+    removed afterwards. Raise 413 when the upload is over max_bytes or the pdf has more than max_pages pages
+    """
+    # imported here, the pdf worker processes import open_source from this module and do not need fastapi
+    from fastapi import HTTPException
+    buffer = bytearray()
+    temp_dir = None
+    spool = None
+    size = 0
+    try:
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f'upload is larger than {max_bytes} bytes')
+            if spool is None and size > spool_threshold:
+                temp_dir = tempfile.mkdtemp()
+                extension = os.path.splitext(os.path.basename(file.filename or ''))[1]
+                spool = open(os.path.join(temp_dir, 'upload' + extension), 'wb')
+                spool.write(buffer)
+                buffer = None
+            if spool is not None:
+                spool.write(chunk)
+            else:
+                buffer += chunk
+
+        if spool is not None:
+            spool.close()
+            input_file = spool.name
+        else:
+            input_file = bytes(buffer)
+            buffer = None
+
+        if max_pages:
+            page_count = count_pdf_pages(input_file)
+            if page_count is not None and page_count > max_pages:
+                raise HTTPException(status_code=413, detail=f'upload has {page_count} pages, the limit is {max_pages}')
+        yield input_file
+    finally:
+        if spool is not None:
+            spool.close()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)